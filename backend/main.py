@@ -1,4 +1,6 @@
+import os
 import json
+import asyncio
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
@@ -10,6 +12,19 @@ from transcription_service import transcriber
 from question_engine import question_engine
 from sentiment_analyzer import sentiment_analyzer
 
+# orjson is several times faster than the standard library on the hot WebSocket path.
+# It produces bytes, which are sent to clients as binary frames.
+# We fall back to the built-in json module if orjson isn't installed.
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
 # --- FastAPI App Setup ---
 app = FastAPI()
 
@@ -17,9 +32,20 @@ app = FastAPI()
 # This allows the browser to access our user interface files.
 app.mount("/frontend", StaticFiles(directory="frontend"), name="frontend")
 
+# The HTML pages are read once at startup and served from memory,
+# so page requests don't hit the disk.
+INDEX_HTML = b""
+PATIENT_HTML = b""
+
 @app.on_event("startup")
 async def startup_event():
     """Code to run when the server starts."""
+    global INDEX_HTML, PATIENT_HTML
+    with open("frontend/index.html", "rb") as f:
+        INDEX_HTML = f.read()
+    with open("frontend/patient.html", "rb") as f:
+        PATIENT_HTML = f.read()
+
     # This is where we could pre-load any other models or resources.
     # The individual services already load their own models upon initialization.
     print("Server has started and all AI models are loaded.")
@@ -33,14 +59,12 @@ async def shutdown_event():
 @app.get("/", response_class=HTMLResponse)
 async def get_doctor_page(request: Request):
     """Serves the main doctor's interface."""
-    with open("frontend/index.html") as f:
-        return HTMLResponse(content=f.read(), status_code=200)
+    return HTMLResponse(content=INDEX_HTML, status_code=200)
 
 @app.get("/patient", response_class=HTMLResponse)
 async def get_patient_page(request: Request):
     """Serves the simple patient interface."""
-    with open("frontend/patient.html") as f:
-        return HTMLResponse(content=f.read(), status_code=200)
+    return HTMLResponse(content=PATIENT_HTML, status_code=200)
 
 # --- WebSocket Endpoints ---
 @app.websocket("/ws/signal")
@@ -57,7 +81,7 @@ async def ws_signal(ws: WebSocket, room: str, speaker: str):
             # Relay the signaling message to the other participant in the room.
             await session_manager.relay_signal(room, speaker, data)
     except WebSocketDisconnect:
-        session_manager.remove_signal_socket(room, speaker)
+        session_manager.remove_signal_socket(room, speaker, ws)
         print(f"Signal socket for {speaker} in room {room} disconnected.")
 
 @app.websocket("/ws/transcribe")
@@ -72,7 +96,7 @@ async def ws_transcribe(ws: WebSocket):
     
     try:
         # The first message must be a "join" message.
-        join_msg = json.loads(await ws.receive_text())
+        join_msg = json_loads(await ws.receive_text())
         if join_msg.get("type") == "join":
             room_id = join_msg["room"]
             speaker_id = join_msg["speaker"]
@@ -83,23 +107,26 @@ async def ws_transcribe(ws: WebSocket):
             return
 
         while True:
-            raw_data = await ws.receive_text()
-            msg = json.loads(raw_data)
+            # Audio arrives as binary frames of raw 16-bit PCM; control messages arrive as JSON text.
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
             
             # --- Main AI Pipeline ---
-            if msg.get("type") == "audio":
+            if message.get("bytes") is not None:
                 # 1. Process and buffer the audio chunk
-                chunk_to_process = transcriber.process_audio_chunk(room_id, speaker_id, msg["data"])
+                chunk_to_process = transcriber.process_audio_chunk_bytes(room_id, speaker_id, message["bytes"])
 
                 if chunk_to_process is not None:
-                    # 2. Transcribe the audio chunk if the buffer is full
-                    full_text = transcriber.transcribe_chunk(chunk_to_process)
+                    # 2. Transcribe the audio chunk if the buffer is full.
+                    # This runs in a worker thread so the event loop keeps serving other sockets.
+                    full_text = await asyncio.to_thread(transcriber.transcribe_chunk, chunk_to_process)
 
                     if full_text:
                         # 3. Analyze sentiment for patient's speech
                         sentiment = None
                         if speaker_id == "Patient":
-                            sentiment = sentiment_analyzer.analyze(full_text)
+                            sentiment = await sentiment_analyzer.analyze(full_text)
 
                         # 4. Store the new transcript line in the session history
                         session_manager.add_to_history(room_id, speaker_id, full_text, sentiment)
@@ -111,33 +138,45 @@ async def ws_transcribe(ws: WebSocket):
                             "text": full_text,
                             "sentiment": sentiment
                         }
-                        await session_manager.broadcast_transcribe(room_id, json.dumps(transcript_event))
+                        await session_manager.broadcast_transcribe(room_id, json_dumps(transcript_event))
 
                         # 6. Generate reflexive questions based on patient's speech
                         if speaker_id == "Patient":
-                            current_history = session_manager.get_history(room_id)
+                            last_patient_text = session_manager.get_last_patient_text(room_id)
                             current_step = session_manager.get_checklist_step(room_id)
-                            questions = await question_engine.generate_question(current_history, current_step)
+                            questions = await question_engine.generate_question(last_patient_text, current_step)
                             
                             if questions:
                                 question_event = {
                                     "type": "question",
                                     "questions": questions
                                 }
-                                await session_manager.broadcast_transcribe(room_id, json.dumps(question_event))
+                                await session_manager.broadcast_transcribe(room_id, json_dumps(question_event))
 
-            # --- Handle checklist updates from the doctor's UI ---
-            elif msg.get("type") == "update_checklist":
-                new_step = msg.get("step")
-                session_manager.update_checklist_step(room_id, new_step)
-                print(f"Room {room_id} advanced to checklist step: {new_step}")
+            # --- Handle JSON control messages, e.g. checklist updates from the doctor's UI ---
+            elif message.get("text") is not None:
+                msg = json_loads(message["text"])
+                if msg.get("type") == "update_checklist":
+                    new_step = msg.get("step")
+                    session_manager.update_checklist_step(room_id, new_step)
+                    print(f"Room {room_id} advanced to checklist step: {new_step}")
 
     except WebSocketDisconnect:
         if room_id and speaker_id:
-            session_manager.remove_transcribe_socket(room_id, speaker_id)
+            session_manager.remove_transcribe_socket(room_id, speaker_id, ws)
+            transcriber.release(room_id, speaker_id)
             print(f"Transcription socket for {speaker_id} in room {room_id} disconnected.")
     except Exception as e:
         print(f"An error occurred in the transcription websocket: {e}")
         if room_id and speaker_id:
-            session_manager.remove_transcribe_socket(room_id, speaker_id)
+            session_manager.remove_transcribe_socket(room_id, speaker_id, ws)
+            transcriber.release(room_id, speaker_id)
+
+
+if __name__ == "__main__":
+    import uvicorn
 
+    # Same settings as the deploy start commands. uvicorn's default "auto" loop and
+    # http choices pick uvloop and httptools when installed (they ship with
+    # uvicorn[standard]), and fall back to asyncio and h11 where they aren't, e.g. on Windows.
+    uvicorn.run("main:app", host="0.0.0.0", port=int(os.environ.get("PORT", 8000)))
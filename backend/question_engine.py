@@ -1,4 +1,5 @@
-from typing import List, Dict
+import re
+from typing import List
 
 class QuestionEngine:
     """
@@ -67,32 +68,40 @@ class QuestionEngine:
             "cancer": ["What type of cancer or tumor was it?", "What was the treatment and when was it completed?"]
         }
 
-    async def generate_question(self, conversation_history: List[Dict], checklist_step: str) -> List[str]:
+        # Compile all keywords into a single regex alternation so a patient's response
+        # is scanned once, instead of once per keyword. A keyword must start at a word
+        # boundary, so it won't fire from the middle of another word (e.g. "thyroid"
+        # inside "hypothyroid"), but may be followed by any ending, so plurals and
+        # forms like "hypothyroidism" or "alcoholic" still match.
+        # Each keyword keeps its position in the rulebook so earlier rules still win
+        # when several match.
+        self._keyword_pattern = re.compile(
+            r"\b(" + "|".join(map(re.escape, self.acko_script_rules)) + r")",
+            re.IGNORECASE,
+        )
+        self._keyword_priority = {keyword: i for i, keyword in enumerate(self.acko_script_rules)}
+
+    async def generate_question(self, last_patient_text: str, checklist_step: str) -> List[str]:
         """
         Generates the next suggested question(s) for the doctor based on keyword matching.
         
         Args:
-            conversation_history: The transcript of the conversation so far.
+            last_patient_text: The most recent thing the patient said.
             checklist_step: The current step in the consultation checklist.
 
         Returns:
             A list of suggested questions, or an empty list if no keyword is matched.
         """
-        last_patient_response = ""
-        # Find the most recent thing the patient said.
-        for entry in reversed(conversation_history):
-            if entry.get("speaker") == "Patient":
-                last_patient_response = entry.get("text", "").lower()
-                break
+        last_patient_response = last_patient_text.lower()
         
         if not last_patient_response:
             return []
 
-        # Iterate through our rulebook to find a matching keyword.
-        for keyword, questions in self.acko_script_rules.items():
-            if keyword in last_patient_response:
-                # If a keyword is found, return the associated follow-up questions immediately.
-                return questions
+        # Scan the response once and pick the matching keyword that comes first in our rulebook.
+        matches = [match.group(1).lower() for match in self._keyword_pattern.finditer(last_patient_response)]
+        if matches:
+            keyword = min(matches, key=self._keyword_priority.__getitem__)
+            return self.acko_script_rules[keyword]
         
         # If no specific keywords are found in the patient's response,
         # return an empty list. The doctor can then proceed with the standard script.
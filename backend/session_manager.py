@@ -1,82 +1,159 @@
+import asyncio
+from collections import defaultdict
 from fastapi import WebSocket
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Union
+
+# How many outgoing messages may queue up for a single slow client before we start dropping.
+SEND_QUEUE_SIZE = 64
 
 class SessionManager:
   
     def __init__(self):
         """Initializes the SessionManager with a dictionary to hold active rooms."""
-        self.rooms: Dict[str, Dict[str, Any]] = {}
-
-    def _ensure_room_exists(self, room_id: str):
-        """A helper function to create a room's data structure if it doesn't exist."""
-        if room_id not in self.rooms:
-            self.rooms[room_id] = {
-                "signal_sockets": {},      # For WebRTC video call connections
-                "transcribe_sockets": {},  # For AI processing connections
-                "history": [],             # Stores the conversation transcript
-                "checklist_step": "Introduction" # The starting step of the consultation
-            }
+        # Rooms are created on first access, so adding a socket is a single lookup.
+        self.rooms: Dict[str, Dict[str, Any]] = defaultdict(self._new_room)
+
+    @staticmethod
+    def _new_room() -> Dict[str, Any]:
+        """Builds the data structure for a newly created room."""
+        return {
+            "signal_sockets": {},      # For WebRTC video call connections
+            "signal_peers": {},        # Maps each signaling speaker to the other participant's socket
+            "transcribe_sockets": {},  # For AI processing connections: (ws, send queue, writer task)
+            "history": [],             # Stores the conversation transcript
+            "last_patient_text": "",   # The patient's most recent line, for the question engine
+            "checklist_step": "Introduction" # The starting step of the consultation
+        }
 
     # --- Connection Management ---
     
     def add_signal_socket(self, room_id: str, speaker_id: str, ws: WebSocket):
         """Adds a signaling WebSocket for a user in a room."""
-        self._ensure_room_exists(room_id)
-        self.rooms[room_id]["signal_sockets"][speaker_id] = ws
+        room = self.rooms[room_id]
+        room["signal_sockets"][speaker_id] = ws
+        self._update_signal_peers(room)
 
-    def remove_signal_socket(self, room_id: str, speaker_id: str):
+    def remove_signal_socket(self, room_id: str, speaker_id: str, ws: WebSocket):
         """Removes a signaling WebSocket and cleans up the room if empty."""
-        if room_id in self.rooms:
-            if speaker_id in self.rooms[room_id]["signal_sockets"]:
-                del self.rooms[room_id]["signal_sockets"][speaker_id]
+        room = self.rooms.get(room_id)
+        if room is not None:
+            # Only remove the socket if it's still the registered one; the speaker
+            # may already have reconnected on a new socket.
+            if room["signal_sockets"].get(speaker_id) is ws:
+                del room["signal_sockets"][speaker_id]
+                self._update_signal_peers(room)
             self._cleanup_room_if_empty(room_id)
 
+    @staticmethod
+    def _update_signal_peers(room: Dict[str, Any]):
+        """Caches each participant's counterpart once both have joined, so relaying needs no search."""
+        sockets = room["signal_sockets"]
+        if len(sockets) == 2:
+            (first_id, first_ws), (second_id, second_ws) = sockets.items()
+            room["signal_peers"] = {first_id: second_ws, second_id: first_ws}
+        else:
+            room["signal_peers"] = {}
+
     def add_transcribe_socket(self, room_id: str, speaker_id: str, ws: WebSocket):
         """Adds a transcription WebSocket for a user in a room."""
-        self._ensure_room_exists(room_id)
-        self.rooms[room_id]["transcribe_sockets"][speaker_id] = ws
-
-    def remove_transcribe_socket(self, room_id: str, speaker_id: str):
+        sockets = self.rooms[room_id]["transcribe_sockets"]
+        # Each connection gets its own send queue drained by a dedicated writer task.
+        previous = sockets.get(speaker_id)
+        if previous:
+            previous[2].cancel()
+        queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        task = asyncio.create_task(self._socket_writer(room_id, speaker_id, ws, queue))
+        sockets[speaker_id] = (ws, queue, task)
+
+    def remove_transcribe_socket(self, room_id: str, speaker_id: str, ws: WebSocket):
         """Removes a transcription WebSocket and cleans up the room if empty."""
-        if room_id in self.rooms:
-            if speaker_id in self.rooms[room_id]["transcribe_sockets"]:
-                del self.rooms[room_id]["transcribe_sockets"][speaker_id]
-            self._cleanup_room_if_empty(room_id)
+        entry = self._discard_transcribe_socket(room_id, speaker_id, ws)
+        if entry:
+            entry[2].cancel()
+
+    def _discard_transcribe_socket(self, room_id: str, speaker_id: str, ws: WebSocket):
+        """
+        Unregisters a transcription WebSocket, but only if it's still the one registered
+        for the speaker; the speaker may already have reconnected on a new socket.
+
+        Returns:
+            The removed (ws, send queue, writer task) entry, or None if nothing was removed.
+        """
+        room = self.rooms.get(room_id)
+        if room is None:
+            return None
+        entry = room["transcribe_sockets"].get(speaker_id)
+        if entry is not None and entry[0] is ws:
+            del room["transcribe_sockets"][speaker_id]
+        else:
+            entry = None
+        self._cleanup_room_if_empty(room_id)
+        return entry
+
+    async def _socket_writer(self, room_id: str, speaker_id: str, ws: WebSocket, queue: asyncio.Queue):
+        """Drains a connection's send queue so a slow client never stalls the rest of the room."""
+        try:
+            while True:
+                data = await queue.get()
+                if isinstance(data, bytes):
+                    await ws.send_bytes(data)
+                else:
+                    await ws.send_text(data)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # The connection is dead; unregister it so broadcasts stop queueing for it.
+            print(f"Error while sending to {speaker_id} in room {room_id}: {e}")
+            self._discard_transcribe_socket(room_id, speaker_id, ws)
 
     # --- Message Broadcasting ---
 
     async def relay_signal(self, room_id: str, sender_id: str, data: str):
         """Relays a WebRTC signaling message to the other user in the room."""
-        if room_id in self.rooms:
-            for speaker_id, ws in self.rooms[room_id]["signal_sockets"].items():
-                if speaker_id != sender_id:
-                    await ws.send_text(data)
+        room = self.rooms.get(room_id)
+        if room is not None:
+            other_ws = room["signal_peers"].get(sender_id)
+            if other_ws is not None:
+                await other_ws.send_text(data)
 
-    async def broadcast_transcribe(self, room_id: str, data: str):
+    async def broadcast_transcribe(self, room_id: str, data: Union[str, bytes]):
         """Broadcasts AI-related data (transcript, questions) to all users in a room."""
-        if room_id in self.rooms:
-            for ws in self.rooms[room_id]["transcribe_sockets"].values():
-                await ws.send_text(data)
+        room = self.rooms.get(room_id)
+        if room is not None:
+            # Enqueue without awaiting the network; each socket's writer task does the sending.
+            for speaker_id, (_, queue, _) in room["transcribe_sockets"].items():
+                try:
+                    queue.put_nowait(data)
+                except asyncio.QueueFull:
+                    print(f"Send queue for {speaker_id} in room {room_id} is full. Dropping message.")
 
     # --- State Management (History & Checklist) ---
 
     def add_to_history(self, room_id: str, speaker_id: str, text: str, sentiment: str = None):
         """Adds a new entry to the conversation history for a room."""
-        if room_id in self.rooms:
-            self.rooms[room_id]["history"].append({
+        room = self.rooms.get(room_id)
+        if room is not None:
+            room["history"].append({
                 "speaker": speaker_id,
                 "text": text,
                 "sentiment": sentiment
             })
+            if speaker_id == "Patient":
+                room["last_patient_text"] = text
 
     def get_history(self, room_id: str) -> List[Dict]:
         """Retrieves the full conversation history for a room."""
         return self.rooms.get(room_id, {}).get("history", [])
 
+    def get_last_patient_text(self, room_id: str) -> str:
+        """Retrieves the most recent thing the patient said in a room."""
+        return self.rooms.get(room_id, {}).get("last_patient_text", "")
+
     def update_checklist_step(self, room_id: str, step: str):
         """Updates the current step of the consultation checklist for a room."""
-        if room_id in self.rooms:
-            self.rooms[room_id]["checklist_step"] = step
+        room = self.rooms.get(room_id)
+        if room is not None:
+            room["checklist_step"] = step
 
     def get_checklist_step(self, room_id: str) -> str:
         """Retrieves the current step of the consultation checklist for a room."""
@@ -86,11 +163,11 @@ class SessionManager:
 
     def _cleanup_room_if_empty(self, room_id: str):
         """Checks if a room is empty and deletes its data if so."""
-        if room_id in self.rooms:
-            # A room is considered empty if both participants have disconnected.
-            if not self.rooms[room_id]["signal_sockets"] and not self.rooms[room_id]["transcribe_sockets"]:
-                print(f"Room {room_id} is empty. Cleaning up session data.")
-                del self.rooms[room_id]
+        room = self.rooms.get(room_id)
+        # A room is considered empty if both participants have disconnected.
+        if room is not None and not room["signal_sockets"] and not room["transcribe_sockets"]:
+            print(f"Room {room_id} is empty. Cleaning up session data.")
+            self.rooms.pop(room_id, None)
 
 # Create a single, global instance of the manager that the main app will use.
 # This ensures all parts of the application share the same state.
@@ -1,8 +1,6 @@
 import os
-import io
-import base64
 import numpy as np
-import soundfile as sf
+from numba import njit, types
 from faster_whisper import WhisperModel
 from typing import Optional
 
@@ -11,8 +9,36 @@ from typing import Optional
 # including English and Hindi, as required by the problem statement.
 MODEL_SIZE = "base" 
 COMPUTE_TYPE = "int8"
+# CTranslate2 threading: each worker handles one transcription at a time using
+# CPU_THREADS threads. More workers let concurrent rooms transcribe in parallel
+# instead of queueing behind each other. For a single-room laptop demo,
+# CPU_THREADS = 4 and NUM_WORKERS = 1 gives the lowest latency.
+CPU_THREADS = 2
+NUM_WORKERS = max(2, (os.cpu_count() or 2) // 2)
 SAMPLE_RATE = 16000
 BUFFER_SECONDS = 2
+# Greedy decoding: beam search buys almost nothing on short 2-second chunks
+# but costs several times the decoder compute.
+BEAM_SIZE = 1
+CHUNK_SAMPLES = SAMPLE_RATE * BUFFER_SECONDS
+INT16_SCALE = np.float32(1.0 / 32768.0)
+# Chunks whose RMS level falls below this are treated as silence and not transcribed.
+SILENCE_THRESHOLD = 0.005
+
+# Compiled eagerly at import for the exact array types we pass in (read-only, as
+# np.frombuffer returns for bytes, and writable), so the first audio packet doesn't
+# stall the event loop on JIT compilation.
+@njit(
+    [
+        types.void(types.Array(types.int16, 1, "C", readonly=True), types.float32[::1]),
+        types.void(types.int16[::1], types.float32[::1]),
+    ],
+    cache=True,
+)
+def _i16_to_f32(src_i16, dst_f32):
+    """Converts 16-bit PCM samples into float32 in [-1, 1), writing into dst_f32."""
+    for i in range(src_i16.size):
+        dst_f32[i] = src_i16[i] * INT16_SCALE
 
 class TranscriptionService:
    
@@ -26,49 +52,65 @@ class TranscriptionService:
             MODEL_SIZE,
             device="cpu", # Forcing CPU usage as requested
             compute_type=COMPUTE_TYPE,
+            cpu_threads=CPU_THREADS,
+            num_workers=NUM_WORKERS,
         )
         print(f"Model '{MODEL_SIZE}' loaded and running on CPU.")
         
         # This dictionary will hold the audio buffers for each participant in each room.
         # The key will be a tuple: (room_id, speaker_id)
+        # Each value is a preallocated float32 buffer plus a write position, so
+        # incoming packets are copied in place instead of re-concatenating the whole buffer.
         self.buffers = {}
 
-    def process_audio_chunk(self, room_id: str, speaker_id: str, base64_data: str) -> Optional[np.ndarray]:
+    def process_audio_chunk_bytes(self, room_id: str, speaker_id: str, audio_bytes: bytes) -> Optional[np.ndarray]:
         """
-        Decodes incoming audio data, adds it to a buffer, and returns a chunk when ready for transcription.
+        Converts incoming audio data, adds it to a buffer, and returns a chunk when ready for transcription.
         
         Args:
             room_id: The unique identifier for the consultation room.
             speaker_id: The identifier for the speaker ('Doctor' or 'Patient').
-            base64_data: The raw audio data, base64-encoded.
+            audio_bytes: The raw 16-bit PCM audio data, as received in a binary WebSocket frame.
             
         Returns:
             A NumPy array of audio samples ready for transcription, or None if the buffer is not yet full.
         """
-        # Decode the base64 string into raw bytes, then convert to a NumPy array of 16-bit integers.
-        audio_bytes = base64.b64decode(base64_data)
+        # View the raw bytes as a NumPy array of 16-bit integers, without copying.
         samples = np.frombuffer(audio_bytes, dtype=np.int16)
         
-        # Convert the audio to float32 format, which is required by the Whisper model.
-        samples = samples.astype(np.float32) / 32768.0
-        
         key = (room_id, speaker_id)
         if key not in self.buffers:
-            self.buffers[key] = np.zeros(0, dtype=np.float32)
-        
-        # Append the new audio samples to the existing buffer for this speaker.
-        self.buffers[key] = np.concatenate([self.buffers[key], samples])
+            self.buffers[key] = {"buf": np.empty(CHUNK_SAMPLES * 2, dtype=np.float32), "write": 0}
+        state = self.buffers[key]
+        buf, write = state["buf"], state["write"]
+
+        # Grow the buffer in the rare case a single packet doesn't fit the free space.
+        if write + len(samples) > len(buf):
+            grown = np.empty(max(len(buf) * 2, write + len(samples)), dtype=np.float32)
+            grown[:write] = buf[:write]
+            buf = state["buf"] = grown
+
+        # Convert the audio to float32 format, which is required by the Whisper model.
+        # The cast and scale happen in one compiled loop, written straight into the buffer.
+        _i16_to_f32(samples, buf[write:write + len(samples)])
+        write += len(samples)
+        state["write"] = write
 
         # Check if the buffer has enough audio to meet our threshold (e.g., 2 seconds).
-        if len(self.buffers[key]) >= SAMPLE_RATE * BUFFER_SECONDS:
-            # If the buffer is full, slice off a chunk to be transcribed.
-            chunk_to_transcribe = self.buffers[key][:SAMPLE_RATE * BUFFER_SECONDS]
-            # Keep the rest of the audio in the buffer for the next cycle.
-            self.buffers[key] = self.buffers[key][SAMPLE_RATE * BUFFER_SECONDS:]
+        if write >= CHUNK_SAMPLES:
+            # If the buffer is full, copy out a chunk to be transcribed.
+            chunk_to_transcribe = buf[:CHUNK_SAMPLES].copy()
+            # Shift the leftover audio to the front for the next cycle.
+            buf[:write - CHUNK_SAMPLES] = buf[CHUNK_SAMPLES:write]
+            state["write"] = write - CHUNK_SAMPLES
             return chunk_to_transcribe
             
         return None
 
+    def release(self, room_id: str, speaker_id: str):
+        """Frees the audio buffer for a speaker who has left, discarding any leftover audio."""
+        self.buffers.pop((room_id, speaker_id), None)
+
     def transcribe_chunk(self, audio_chunk: np.ndarray) -> str:
         """
         Transcribes a chunk of audio using the loaded Whisper model.
@@ -81,20 +123,29 @@ class TranscriptionService:
         """
         if audio_chunk is None or audio_chunk.size == 0:
             return ""
+
+        # Skip the model entirely when nobody is speaking. This is one vectorized
+        # reduction, far cheaper than even faster-whisper's own VAD pass.
+        rms = np.sqrt(np.dot(audio_chunk, audio_chunk) / audio_chunk.size)
+        if rms < SILENCE_THRESHOLD:
+            return ""
             
-        # The model expects audio in WAV format. We create this in-memory.
-        with io.BytesIO() as wav_buffer:
-            sf.write(wav_buffer, audio_chunk, SAMPLE_RATE, format="WAV")
-            wav_buffer.seek(0)
-            
-            # This is the core transcription call.
-            # language=None enables automatic language detection (for English/Hindi).
-            # vad_filter=True helps remove silence and improves accuracy.
-            segments, _ = self.model.transcribe(wav_buffer, beam_size=5, vad_filter=True, language=None)
-            
-            # Join all transcribed segments into a single coherent sentence.
-            full_text = " ".join(segment.text.strip() for segment in segments)
-            return full_text
+        # faster-whisper accepts a float32 mono array at 16 kHz directly, so we
+        # pass the chunk straight in instead of round-tripping through a WAV file.
+        # language=None enables automatic language detection (for English/Hindi).
+        # vad_filter=True helps remove silence and improves accuracy.
+        # Each chunk is transcribed independently, so we don't condition on previous text.
+        segments, _ = self.model.transcribe(
+            audio_chunk,
+            beam_size=BEAM_SIZE,
+            vad_filter=True,
+            language=None,
+            condition_on_previous_text=False,
+        )
+
+        # Join all transcribed segments into a single coherent sentence.
+        full_text = " ".join(segment.text.strip() for segment in segments)
+        return full_text
 
 # Create a single, global instance of the service that the main app will use.
 # This ensures the heavy AI model is only loaded into memory once.